@@ -1,15 +1,69 @@
 
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import json
+import multiprocessing as mp
+import os
+import re
+import shlex
+import shutil
 import subprocess
+import sys
+import threading
 import mikeio
+from mikecore.DfsFileFactory import DfsFileFactory
 import psutil
 from pathlib import Path
 import numpy as np
 import mikeio
-import matplotlib.colors as mcolors
-import matplotlib.patches as mpatches
-from cartopy import crs as ccrs
-import matplotlib.pyplot as plt
+# The plotting stack is imported lazily via _init_plotting: worker
+# processes that only create Manning/sim files and run simulations never
+# pay the cartopy/matplotlib import cost.
+plt = None
+mpatches = None
+_PROJ_PC = None
+_XLOC = None
+_YLOC = None
+_zone_cmap = None
+
+# Figure/axes reused across plot_zones calls, keyed by figsize, so a
+# figure per trial does not keep allocating fresh rasterization buffers.
+_FIG_CACHE = {}
+
+def _init_plotting():
+    """Imports matplotlib/cartopy and builds the objects shared across
+    plot_zones calls, once, on first plot."""
+    global plt, mpatches, _PROJ_PC, _XLOC, _YLOC, _zone_cmap
+
+    if plt is not None:
+        return
+
+    import matplotlib
+    # Only pick Agg when no backend is active yet; a notebook session that
+    # already imported pyplot keeps its inline backend.
+    if "matplotlib.pyplot" not in sys.modules:
+        matplotlib.use("Agg")
+    import matplotlib.colors as mcolors
+    import matplotlib.patches
+    import matplotlib.ticker as mticker
+    import matplotlib.pyplot
+    from cartopy import crs as ccrs
+
+    plt = matplotlib.pyplot
+    mpatches = matplotlib.patches
+    _PROJ_PC = ccrs.PlateCarree()
+    _XLOC = mticker.FixedLocator(np.arange(-2, 10, 2))
+    _YLOC = mticker.FixedLocator(np.arange(50, 57, 1))
+
+    cmap_base = plt.get_cmap("tab20")
+
+    @functools.lru_cache(maxsize=32)
+    def zone_cmap(n_colors):
+        colors = [cmap_base(i % cmap_base.N) for i in range(n_colors)]
+        return mcolors.ListedColormap(colors, name=f"tab20_{n_colors}")
+
+    _zone_cmap = zone_cmap
 
 class Collector:
     def __init__(self, simfile, manning_file, zones):
@@ -17,6 +71,32 @@ class Collector:
         self.zones = zones
         self.manning_file = manning_file
 
+        # One concatenated index per dimension plus per-zone (start, stop)
+        # spans, so assigning all zones is a single fancy-index store per
+        # trial instead of one store per zone.
+        self.flat_zone_idx = tuple(
+            np.concatenate([zone[dim] for zone in zones]) for dim in range(len(zones[0]))
+        )
+        sizes = np.array([zone[0].size for zone in zones])
+        stops = np.cumsum(sizes)
+        self.zone_spans = list(zip(stops - sizes, stops))
+
+        # Parsed once on first use; trials only change the Manning file
+        # reference, so a copy of the template replaces a re-parse.
+        self._pfs_template = None
+
+        # Base Manning values plus a reusable scratch buffer, so each trial
+        # is a memcpy and a zone write instead of a fresh read + allocation.
+        # Kept float32 throughout: dfs items store float32, so the float64
+        # arrays mikeio returns would double memory traffic for no precision.
+        # This read also validates the file structure once — item present,
+        # shape and dtype known — so the per-trial paths can assume success.
+        ds = mikeio.read(manning_file, items="manning")
+        self._base_values = ds["manning"].values.astype(np.float32, copy=False)
+        self._scratch = np.empty_like(self._base_values)
+        self._manning_shape = self._base_values.shape
+        self._manning_dtype = self._base_values.dtype
+
 def read_num_timesteps(simfile) -> int:
     """
     Reads the number of timesteps from the simulation file.
@@ -30,29 +110,109 @@ def read_num_timesteps(simfile) -> int:
     time_step_field = getattr(simfile_pfs, "FemEngineHD").TIME
     return time_step_field.number_of_time_steps
 
+_POOL = None
+_POOL_WORKERS = None
+
+def get_pool(max_workers) -> ProcessPoolExecutor:
+    """
+    Returns a process pool that is created once and reused across trials.
+
+    Spawned workers pay the Python + mikeio import cost a single time and
+    stay warm, so submitting e.g. run_simulation for independent trials does
+    not re-pay worker startup per trial. The pool is sized on the first
+    call; requesting a different size afterwards raises, since the existing
+    workers cannot be resized. Call shutdown_pool when done with it.
+
+    Returns:
+        ProcessPoolExecutor: The shared executor.
+    """
+    global _POOL, _POOL_WORKERS
+
+    if _POOL is None:
+        _POOL = ProcessPoolExecutor(max_workers=max_workers, mp_context=mp.get_context("spawn"))
+        _POOL_WORKERS = max_workers
+    elif max_workers != _POOL_WORKERS:
+        raise ValueError(f"Shared pool was created with max_workers={_POOL_WORKERS}; cannot resize to {max_workers}")
+
+    return _POOL
+
+def shutdown_pool():
+    """Shuts down the shared pool and lets its workers exit; the next
+    get_pool call creates a fresh one."""
+    global _POOL, _POOL_WORKERS
+
+    if _POOL is not None:
+        _POOL.shutdown(wait=True)
+        _POOL = None
+        _POOL_WORKERS = None
+
+def _drain_stderr(stream, sink):
+    """Reads stderr to exhaustion so the engine can never block on a full
+    stderr pipe while stdout is being consumed."""
+    for line in stream:
+        sink.append(line.decode("cp1252", errors="replace").strip())
+
 def run_simulation(command, timesteps):
     timestep_old = 0
 
-    process = subprocess.Popen(command, 
-                               stdout=subprocess.PIPE, 
+    # No shell in the critical path: on Windows a command string goes
+    # straight to CreateProcess, on POSIX exec wants an argv list.
+    if isinstance(command, str) and os.name != "nt":
+        command = shlex.split(command)
+
+    process = subprocess.Popen(command,
+                               stdout=subprocess.PIPE,
                                stderr=subprocess.PIPE,
-                               shell=True, 
-                               text=True, 
-                               encoding = "cp1252",
-                               bufsize=1)
+                               shell=False,
+                               bufsize=65536,
+                               creationflags=subprocess.CREATE_NO_WINDOW if os.name == "nt" else 0)
+
+    flush_threshold = max(1, timesteps // 500)
+    pending = 0
+
+    # Drain stderr on a daemon thread in parallel with the stdout loop;
+    # reading it only after stdout hits EOF can deadlock once the engine
+    # fills the stderr pipe buffer.
+    stderr_lines = []
+    stderr_thread = None
+    if process.stderr is not None:
+        stderr_thread = threading.Thread(target=_drain_stderr, args=(process.stderr, stderr_lines), daemon=True)
+        stderr_thread.start()
 
     try:
-        with tqdm(total=timesteps, desc="Processing", unit="step") as pbar:
+        with tqdm(total=timesteps, desc="Processing", unit="step", mininterval=0.5, smoothing=0.05) as pbar:
             if process.stdout is not None:
-                for line in process.stdout:
-                    if "Time step:" in line:
-                        try:
-                            timestep = int(line.split(":")[1].strip())
-                            pbar.update(timestep - timestep_old)
-                            timestep_old = timestep
-
-                        except ValueError as e:
-                            print(f"Failed to parse timestep from line: {line.strip()} ({e})")
+                # Read the pipe in large binary chunks and only decode the few
+                # lines that actually carry a timestep, instead of decoding
+                # every engine log line through the cp1252 codec.
+                fd = process.stdout.fileno()
+                leftover = bytearray()
+
+                while True:
+                    chunk = os.read(fd, 65536)
+                    if not chunk:
+                        break
+
+                    leftover += chunk
+                    lines = leftover.split(b"\n")
+                    leftover = bytearray(lines.pop())
+
+                    for line in lines:
+                        if b"Time step:" in line:
+                            try:
+                                timestep = int(line.split(b":", 1)[1].strip())
+                                pending += timestep - timestep_old
+                                timestep_old = timestep
+
+                                if pending >= flush_threshold:
+                                    pbar.update(pending)
+                                    pending = 0
+
+                            except ValueError as e:
+                                print(f"Failed to parse timestep from line: {line.decode('cp1252', errors='replace').strip()} ({e})")
+
+                if pending:
+                    pbar.update(pending)
 
     except KeyboardInterrupt:
         print("Simulation interrupted. Terminating the process...")
@@ -60,9 +220,11 @@ def run_simulation(command, timesteps):
         print("Process terminated successfully.")
         raise
 
-    if process.stderr is not None:
-        for line in process.stderr:
-            print(f"{line.strip()}")
+    if stderr_thread is not None:
+        stderr_thread.join()
+
+    for line in stderr_lines:
+        print(line)
 
     process.wait()
 
@@ -90,12 +252,24 @@ def _get_detached_child_processes(process) -> list[psutil.Process]:
 
     This function identifies child processes that were created within a 30-second window
     around the start time of the main simulation process and contain 'FemEngine' in their name.
+    The process tree below the main process is checked first; the system-wide scan is only
+    used as a fallback when no matching children are found there.
 
     Returns:
         list[psutil.Process]: A list of psutil.Process objects representing the detached child processes.
     """
 
-    main_process_start_time = psutil.Process(process.pid).create_time()
+    main_process = psutil.Process(process.pid)
+    main_process_start_time = main_process.create_time()
+
+    candidates = [
+        child
+        for child in main_process.children(recursive=True)
+        if "FemEngine" in child.name()
+    ]
+
+    if candidates:
+        return candidates
 
     time_window_start = main_process_start_time - 30
     time_window_end = main_process_start_time + 30
@@ -106,52 +280,87 @@ def _get_detached_child_processes(process) -> list[psutil.Process]:
         if "FemEngine" in proc.info["name"] and time_window_start <= proc.info["create_time"] <= time_window_end
     ]
 
-def create_new_manning_file(trial_no, manning_file, zones, new_values) -> Path:
+_TRIAL_RE = re.compile(r"_trial_\d+$")
 
-    def _create_new_manning_file_path(manning_file, trial_no) -> Path:
-        if f"_trial_" not in manning_file.as_posix():
-            return Path(manning_file).with_stem(f"{manning_file.stem}_trial_{trial_no}")
-        else:
-            return Path(manning_file).with_stem(manning_file.stem.replace(f"_trial_{trial_no - 1}", f"_trial_{trial_no}"))
-        
-    try:
-        ds = mikeio.read(manning_file, items="manning")
-    except ValueError:
-        raise ValueError(f"Failed to read {manning_file}")
+def _with_trial_suffix(path, trial_no) -> Path:
+    """Returns the path with its stem suffixed by the trial number, replacing
+    any existing _trial_<n> suffix in a single regex pass over the stem."""
+    return Path(path).with_stem(f"{_TRIAL_RE.sub('', path.stem)}_trial_{trial_no}")
 
-    new_ds = ds.copy()
+def create_new_manning_file(trial_no, manning_file, zones, new_values, collector=None) -> Path:
 
-    for i, zone in enumerate(zones):
-        new_ds["manning"].values[zone] = new_values[i]
+    if collector is not None:
+        # Restore the base field into the preallocated scratch buffer and
+        # apply all zone values in one fancy-index store; no read and no
+        # fresh allocation per trial.
+        arr = collector._scratch
+        np.copyto(arr, collector._base_values)
+
+        vals = np.empty(collector.flat_zone_idx[0].size, dtype=arr.dtype)
+        for i, (start, stop) in enumerate(collector.zone_spans):
+            vals[start:stop] = new_values[i]
+        arr[collector.flat_zone_idx] = vals
+    else:
+        try:
+            ds = mikeio.read(manning_file, items="manning")
+        except ValueError:
+            raise ValueError(f"Failed to read {manning_file}")
 
-    new_manning_file = _create_new_manning_file_path(manning_file, trial_no)
+        # ds is a fresh read, so mutate it in place instead of copying the
+        # whole dataset just to overwrite one item.
+        arr = ds["manning"].values.astype(np.float32, copy=False)
+
+        for i, zone in enumerate(zones):
+            arr[zone] = new_values[i]
+
+    new_manning_file = _with_trial_suffix(manning_file, trial_no)
 
     try:
-        new_ds.to_dfs(new_manning_file)
+        # Copy the original file and overwrite only the manning item's data
+        # block in place, instead of re-serializing header, geometry and all
+        # items through to_dfs.
+        shutil.copyfile(manning_file, new_manning_file)
+        dfs = DfsFileFactory.DfsGenericOpenEdit(str(new_manning_file))
+        dfs.WriteItemTimeStepNext(0, arr.astype(np.float32, copy=False).ravel())
+        dfs.Close()
     except Exception as e:
         raise Exception(f"Failed to write new manning file: {e}")
 
     return new_manning_file
 
-def create_new_simfile(trial_no, simfile, manning_file) -> Path:
-        
-    def _create_new_simfile_path(simfile, trial_no) -> Path:
-        if f"_trial_" not in simfile.as_posix():
-            return Path(simfile).with_stem(f"{simfile.stem}_trial_{trial_no}")
-        else:
-            return Path(simfile).with_stem(simfile.stem.replace(f"_trial_{trial_no - 1}", f"_trial_{trial_no}"))
-            
-    pfs = mikeio.read_pfs(simfile)
+def create_new_simfile(trial_no, simfile, manning_file, collector=None) -> Path:
 
-    try:
-        pfs.HD.BED_RESISTANCE.MANNING_NUMBER.file_name = f"|{manning_file.resolve()}|"
+    if collector is not None:
+        if collector._pfs_template is None:
+            template = mikeio.read_pfs(simfile)
+
+            # Validate the bed resistance section once at template creation;
+            # per-trial copies are then updated without exception handling.
+            try:
+                _ = template.HD.BED_RESISTANCE.MANNING_NUMBER
+            except AttributeError as e:
+                raise AttributeError(f"Error updating simfile: {e}")
 
-        pfs.HD.BED_RESISTANCE.MANNING_NUMBER.item_number = 1
-        pfs.HD.BED_RESISTANCE.MANNING_NUMBER.item_name = "manning"
-    except AttributeError as e:
-        raise AttributeError(f"Error updating simfile: {e}")
+            collector._pfs_template = template
 
-    new_simfile = _create_new_simfile_path(simfile, trial_no)
+        pfs = collector._pfs_template.copy()
+
+        manning_number = pfs.HD.BED_RESISTANCE.MANNING_NUMBER
+        manning_number.file_name = f"|{manning_file.resolve()}|"
+        manning_number.item_number = 1
+        manning_number.item_name = "manning"
+    else:
+        pfs = mikeio.read_pfs(simfile)
+
+        try:
+            pfs.HD.BED_RESISTANCE.MANNING_NUMBER.file_name = f"|{manning_file.resolve()}|"
+
+            pfs.HD.BED_RESISTANCE.MANNING_NUMBER.item_number = 1
+            pfs.HD.BED_RESISTANCE.MANNING_NUMBER.item_name = "manning"
+        except AttributeError as e:
+            raise AttributeError(f"Error updating simfile: {e}")
+
+    new_simfile = _with_trial_suffix(simfile, trial_no)
 
     try:
         pfs.write(new_simfile)
@@ -176,7 +385,48 @@ def suggest_new_manning(trial, zones):
     
     return new_values
 
+def _zone_decomposition(values):
+    """
+    Decomposes a value field into its sorted unique values, the per-cell zone
+    index and the flat cell indices of each zone, with a single sort of the
+    field powering all three.
+
+    Returns:
+        tuple: (unique values, zone index array shaped like values, list of
+        flat index arrays, one per zone).
+    """
+    unique_values, inverse = np.unique(values.ravel(), return_inverse=True)
+    order = np.argsort(inverse, kind="stable")
+    counts = np.bincount(inverse)
+    splits = np.cumsum(counts)[:-1]
+    groups = np.split(order, splits)
+
+    return unique_values, inverse.reshape(values.shape), groups
+
 def find_zones(manning_file):
+    """
+    Finds the Manning zones in the given file.
+
+    Results are cached in .zones.npy/.zones.json sidecars next to the file,
+    keyed by its mtime and size, so a cache hit is a single np.load of the
+    index array plus the small JSON manifest instead of a dfs decode and a
+    full sort.
+
+    Returns:
+        list: One np.where-style index tuple per unique Manning value.
+    """
+    manning_file = Path(manning_file)
+    indices_file = manning_file.with_suffix(".zones.npy")
+    meta_file = manning_file.with_suffix(".zones.json")
+    stat = manning_file.stat()
+
+    if indices_file.exists() and meta_file.exists():
+        meta = json.loads(meta_file.read_text())
+        if meta["mtime"] == stat.st_mtime and meta["size"] == stat.st_size:
+            shape = tuple(meta["shape"])
+            indices = np.load(indices_file)
+            groups = np.split(indices, np.cumsum(meta["counts"])[:-1])
+            return [np.unravel_index(group, shape) for group in groups]
 
     try:
         ds = mikeio.read(manning_file, items="manning")
@@ -185,33 +435,47 @@ def find_zones(manning_file):
 
     values =  ds["manning"].values
 
-    zones = []
-    for value in np.unique(values):
-        zones.append(np.where(values == value))
+    _, _, groups = _zone_decomposition(values)
+
+    np.save(indices_file, np.concatenate(groups))
+    meta_file.write_text(json.dumps({
+        "mtime": stat.st_mtime,
+        "size": stat.st_size,
+        "shape": list(values.shape),
+        "counts": [int(group.size) for group in groups],
+    }))
+
+    zones = [np.unravel_index(group, values.shape) for group in groups]
 
     return zones
 
 
-def plot_zones(da, savepath):
+def plot_zones(da, savepath, dpi=150):
+
+    _init_plotting()
+
+    figsize = (11, 8.5)
+    if figsize in _FIG_CACHE:
+        fig, ax = _FIG_CACHE[figsize]
+        ax.cla()
+    else:
+        fig = plt.figure(figsize=figsize)
+        ax = plt.subplot(1, 1, 1, projection=_PROJ_PC)
+        # Detach from pyplot's figure manager right away; the cached
+        # figure is driven directly, so nothing piles up in a GUI backend.
+        plt.close(fig)
+        _FIG_CACHE[figsize] = (fig, ax)
 
-    import matplotlib.ticker as mticker
-    projPC = ccrs.PlateCarree()
-    fig = plt.figure(figsize=(11, 8.5))
-    ax = plt.subplot(1, 1, 1, projection=projPC)
     gl = ax.gridlines(draw_labels=True, linewidth=1, color="gray", alpha=0.5, linestyle="--")
 
-    gl.xlocator = mticker.FixedLocator(np.arange(-2, 10, 2))
-    gl.ylocator = mticker.FixedLocator(np.arange(50, 57, 1))  
+    gl.xlocator = _XLOC
+    gl.ylocator = _YLOC
 
-    unique_values = np.unique(da.values)
+    unique_values, inverse, _ = _zone_decomposition(da.values)
 
-    n_colors = len(unique_values)
-    cmap_base = plt.get_cmap("tab20")
-    colors = [cmap_base(i % cmap_base.N) for i in range(n_colors)]
-    cmap = mcolors.ListedColormap(colors, name="custom_tab20")
+    cmap = _zone_cmap(len(unique_values))
 
-    value_mapping = {v: i for i, v in enumerate(unique_values)}
-    reassigned_values = np.vectorize(value_mapping.get)(da.values)
+    reassigned_values = inverse.astype(np.int16, copy=False)
     da_new = mikeio.DataArray(reassigned_values, time=da.time, geometry=da.geometry)
 
     da_new.plot(
@@ -220,6 +484,11 @@ def plot_zones(da, savepath):
         add_colorbar=False,
     )
 
+    # Rasterize the mesh layer so saving does not emit one path per element;
+    # labels and gridlines stay vector.
+    for collection in ax.collections:
+        collection.set_rasterized(True)
+
     legend_patches = []
     for i, val in enumerate(unique_values):
         color = cmap(i)
@@ -250,4 +519,7 @@ def plot_zones(da, savepath):
     ax.set_title("")
 
     if savepath is not None:
-        fig.savefig(savepath, dpi=300, bbox_inches="tight")
\ No newline at end of file
+        # compress_level=1 trades a somewhat larger PNG for a much faster
+        # encode; pass dpi=300 for a final publication-quality figure.
+        extra = {"pil_kwargs": {"compress_level": 1}} if Path(savepath).suffix.lower() == ".png" else {}
+        fig.savefig(savepath, dpi=dpi, bbox_inches="tight", **extra)
\ No newline at end of file